@@ -0,0 +1,60 @@
+import re
+import uuid
+from shlex import quote as q
+
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+
+class CommandBatch:
+    """
+    Queues remote commands and runs all of them as a single remote script,
+    saving a round-trip per command.
+
+    Each command gets its own invoke Result with its exit code and combined
+    stdout and stderr.
+    """
+
+    def __init__(self, connection, stop_on_error=True):
+        self.connection = connection
+        self.stop_on_error = stop_on_error
+        self.commands = []
+
+    def add(self, command):
+        """
+        Queues command, returns its index in the results list
+        """
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def _script(self, marker):
+        lines = []
+        for i, command in enumerate(self.commands):
+            lines.append("echo {}-begin".format(marker))
+            lines.append("( {}\n) 2>&1".format(command))
+            lines.append('rc=$?; echo; echo "{}-end {} $rc"'.format(marker, i))
+            if self.stop_on_error:
+                lines.append("[ $rc -eq 0 ] || exit 0")
+        return "\n".join(lines)
+
+    def run(self, warn=False):
+        """
+        Runs queued commands. Raises UnexpectedExit for the first failed
+        command unless warn is set.
+
+        With stop_on_error commands after the failed one are not run and have
+        no results.
+        """
+        marker = "batch-" + uuid.uuid4().hex
+        output = self.connection.run("bash -c " + q(self._script(marker)))
+        results = []
+        for match in re.finditer(r"{0}-begin\n(.*?)\n{0}-end (\d+) (\d+)\n"
+                                 .format(marker), output.stdout, re.S):
+            results.append(Result(stdout=match.group(1),
+                                  command=self.commands[int(match.group(2))],
+                                  exited=int(match.group(3))))
+        self.commands = []
+        failed = [result for result in results if not result.ok]
+        if failed and not warn:
+            raise UnexpectedExit(failed[0])
+        return results
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+"""
+Benchmark of deploy, change_version, list_versions and delete_old_versions
+against a local stand-in of the production host.
+
+Remote commands run locally in a temporary home directory, repositories are
+local git repositories and check_app_works probes a stub HTTP server. For
+each task wall time, number of remote commands and bytes of commands and
+their output are reported.
+"""
+import argparse
+import getpass
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from invoke import Config, Context
+
+import fabfile
+import report
+from django_connection import CountingMixin, DjangoConnection
+from logger import logger
+from streaming import StreamingLocal
+
+MANAGE_PY = """#!/usr/bin/env python
+import sys
+if sys.argv[1:2] == ["migrate"] and "--plan" in sys.argv:
+    print("Planned operations:")
+    print("  No planned migration operations.")
+"""
+
+BACKUP_SCRIPT = """#!/bin/sh
+head -c 200000 /dev/zero > ~/backup.sql && echo ~/backup.sql
+"""
+
+
+class LocalConnection(CountingMixin, Context):
+    """
+    Stand-in for fabric Connection running commands locally with HOME set to
+    the benchmark home directory
+    """
+    is_connected = True
+
+    def __init__(self, host, user, config):
+        super().__init__(config=config)
+        self.host = host
+        self.user = user
+
+    def run(self, command, **kwargs):
+        return super().run(command, **self._local_options(kwargs))
+
+    def _stream(self, command, **kwargs):
+        return self._run(StreamingLocal(self), command,
+                         **self._local_options(kwargs))
+
+    def _local_options(self, kwargs):
+        kwargs.setdefault("env", {
+            'HOME': self.config.bench_home,
+            'PATH': self.config.bench_path,
+        })
+        kwargs.setdefault("hide", True)
+        return kwargs
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class OkHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"OK")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def git(path, *args):
+    return subprocess.check_output(
+        ["git", "-C", path, "-c", "user.name=bench",
+         "-c", "user.email=bench@localhost"] + list(args)
+    ).decode().strip()
+
+
+def commit(repo, filename, content):
+    with open(os.path.join(repo, filename), "w") as f:
+        f.write(content)
+    if content.startswith("#!"):
+        os.chmod(os.path.join(repo, filename), 0o755)
+    git(repo, "add", filename)
+    git(repo, "commit", "--quiet", "-m", "Change " + filename)
+    return git(repo, "rev-parse", "HEAD")
+
+
+def make_repository(path, files):
+    subprocess.check_call(["git", "init", "--quiet", path])
+    git(path, "checkout", "--quiet", "-b", "master")
+    for filename, content in files.items():
+        commit(path, filename, content)
+    return git(path, "rev-parse", "HEAD")
+
+
+def write_script(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def setup(root, website_url):
+    """
+    Creates repositories, fake home and bin directories and returns config
+    and the first code and config commits
+    """
+    home = os.path.join(root, "home")
+    bin_dir = os.path.join(root, "bin")
+    for path in (home, bin_dir, os.path.join(home, "scripts")):
+        os.makedirs(path)
+    write_script(os.path.join(bin_dir, "sudo"), "#!/bin/sh\nexit 0\n")
+    os.symlink(sys.executable, os.path.join(bin_dir, "python"))
+    write_script(os.path.join(home, "scripts", "backup_database.sh"),
+                 BACKUP_SCRIPT)
+
+    code_repo = os.path.join(root, "code")
+    config_repo = os.path.join(root, "config")
+    code_commit = make_repository(code_repo, {
+        'requirements.txt': "",
+        'app.py': "print('hello')\n",
+    })
+    config_commit = make_repository(config_repo, {'manage.py': MANAGE_PY})
+
+    user = getpass.getuser()
+    config = Config(overrides={
+        'host': "bench",
+        'bench_home': home,
+        'bench_path': bin_dir + os.pathsep + os.environ['PATH'],
+        'versions_dir': home,
+        'website_url': website_url,
+        'code_repo_url': code_repo,
+        'config_repo_url': config_repo,
+        'code_branch': "master",
+        'config_branch': "master",
+        'admin_username': user,
+        'app_username': user,
+        'maintenance_start_script': "true",
+        'maintenance_stop_script': "true",
+        'report_file': None,
+        'report_history_file': None,
+    })
+    config.load_collection(fabfile.ns.configuration())
+    return config, code_repo, code_commit, config_commit
+
+
+def bootstrap(c, code_commit, config_commit):
+    """
+    Creates the first version and the symlinks deploy expects
+    """
+    version = os.path.basename(
+        fabfile.create_version(c, code_commit, config_commit))
+    home = c.config.bench_home
+    for link in ("django-current", "django-previous", "django-working",
+                 "django-previous-working"):
+        os.symlink(os.path.join(home, version), os.path.join(home, link))
+    os.symlink(os.path.join(home, "django-current", "venv"),
+               os.path.join(home, "venv"))
+    os.symlink(os.path.join(home, "django-current", "code"),
+               os.path.join(home, "django"))
+    os.makedirs(os.path.join(home, "deployment"))
+    os.symlink(os.path.join(home, "django-current", "config", "manage.py"),
+               os.path.join(home, "deployment", "manage.py"))
+    return version
+
+
+def measure(name, task, *args, **kwargs):
+    for host_report in report.reports.values():
+        host_report.reset()
+    start = time.monotonic()
+    try:
+        task(*args, **kwargs)
+        success = True
+    except SystemExit as e:
+        success = not e.code
+    duration = time.monotonic() - start
+    return {
+        'task': name,
+        'success': success,
+        'wall_time': duration,
+        'commands': sum(r.commands for r in report.reports.values()),
+        'bytes': sum(r.bytes for r in report.reports.values()),
+    }
+
+
+def check_limits(results, max_commands, baseline, max_slowdown):
+    """
+    Returns messages about results exceeding command limits by task, more
+    commands than in the baseline results or wall time longer than
+    max_slowdown times the baseline one
+    """
+    errors = []
+    for result in results:
+        limit = max_commands.get(result['task'])
+        if limit is not None and result['commands'] > limit:
+            errors.append("{} ran {} commands, limit is {}".format(
+                result['task'], result['commands'], limit))
+    for result, base in zip(results, baseline or []):
+        if result['task'] != base['task']:
+            errors.append("Baseline has {} instead of {}".format(
+                base['task'], result['task']))
+            break
+        if result['commands'] > base['commands']:
+            errors.append("{} ran {} commands, baseline {}".format(
+                result['task'], result['commands'], base['commands']))
+        if max_slowdown is not None \
+                and result['wall_time'] > base['wall_time'] * max_slowdown:
+            errors.append("{} took {:.2f}s, baseline {:.2f}s".format(
+                result['task'], result['wall_time'], base['wall_time']))
+    return errors
+
+
+def parse_limit(text):
+    task, limit = text.split("=")
+    return task, int(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="Save results as JSON to this file")
+    parser.add_argument("--max-commands", metavar="TASK=N", type=parse_limit,
+                        action="append", default=[],
+                        help="Fail if TASK runs more than N remote commands")
+    parser.add_argument("--baseline",
+                        help="Fail if a task runs more remote commands than "
+                             "in these results saved with --json")
+    parser.add_argument("--max-slowdown", type=float,
+                        help="With --baseline also fail if a task takes more "
+                             "than this times its baseline wall time")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    DjangoConnection.connection_class = LocalConnection
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as root:
+        config, code_repo, code_commit, config_commit = setup(
+            root, "http://127.0.0.1:{}/".format(server.server_port))
+        c = Context(config=config)
+        logger.info("Bootstrapping")
+        first_version = bootstrap(c, code_commit, config_commit)
+
+        results = []
+        for i in range(2):
+            new_commit = commit(code_repo, "app.py",
+                                "print('hello {}')\n".format(i))
+            results.append(measure("deploy", fabfile.deploy, c, new_commit,
+                                   config_commit))
+        results.append(measure("change_version", fabfile.change_version, c,
+                               first_version))
+        results.append(measure("list_versions", fabfile.list_versions, c))
+        results.append(measure("delete_old_versions",
+                               fabfile.delete_old_versions, c, to_keep=1))
+    server.shutdown()
+
+    print("{:<22}{:>8}{:>12}{:>10}{:>12}".format(
+        "task", "result", "wall time", "commands", "bytes"))
+    for result in results:
+        print("{task:<22}{status:>8}{wall_time:>11.2f}s{commands:>10}"
+              "{bytes:>12}".format(
+                  status="ok" if result['success'] else "FAILED", **result))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    errors = check_limits(results, dict(args.max_commands), baseline,
+                          args.max_slowdown)
+    for error in errors:
+        print(error)
+    if errors or not all(result['success'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Long running deploy service. Keeps Python modules loaded and SSH connections
+(see DjangoConnection.get_instance) open between deploys.
+
+safe_caller uses it when caller_config.daemon_socket is set. The client sends
+a JSON line {"code": ..., "config": ...}, the daemon streams the deploy output
+as {"output": ...} lines and finishes with {"exit": exit code}.
+"""
+import json
+import logging
+import os
+import socketserver
+import sys
+import threading
+from contextlib import redirect_stdout
+
+from fabric import Config
+from invoke import Context
+
+import fabfile
+from logger import logger
+
+
+class SocketWriter:
+    """
+    Sends output to the client. Once the client is gone further output is
+    dropped, losing the client must not abort a running deploy.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def write(self, text):
+        if text and self.connected:
+            try:
+                self.wfile.write(
+                    (json.dumps({'output': text}) + "\n").encode())
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class DeployHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        writer = SocketWriter(self.wfile)
+        handler = logging.StreamHandler(writer)
+        handler.setLevel(logging.INFO)
+        with self.server.deploy_lock:
+            logger.addHandler(handler)
+            try:
+                with redirect_stdout(writer):
+                    exit_code = self.server.deploy(request['code'],
+                                                   request['config'])
+            finally:
+                logger.removeHandler(handler)
+        if writer.connected:
+            try:
+                self.wfile.write(
+                    (json.dumps({'exit': exit_code}) + "\n").encode())
+            except OSError:
+                pass
+        logger.info("Deploy finished with exit code {}".format(exit_code))
+
+
+class DeployServer(socketserver.ThreadingUnixStreamServer):
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, DeployHandler)
+        self.deploy_lock = threading.Lock()
+        self.config = Config(project_location=os.getcwd())
+        self.config.load_collection(fabfile.ns.configuration())
+        self.config.load_project()
+
+    def deploy(self, code_commit, config_commit):
+        """
+        Runs deploy task, returns exit code a fab call would have
+        """
+        logger.info("Deploying {} {}".format(code_commit, config_commit))
+        try:
+            fabfile.deploy(Context(config=self.config.clone()), code_commit,
+                           config_commit)
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            logger.exception(e)
+            return 199
+        return 0
+
+
+def main():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else "deploy.sock"
+    server = DeployServer(socket_path)
+    logger.info("Listening on {}".format(socket_path))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
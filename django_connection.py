@@ -1,73 +1,547 @@
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from fabric import Connection
 from shlex import quote as q
+import datetime
+import json
 import os
-import requests
+import re
 
+from batch import CommandBatch
 from logger import logger
+from probes import ReadinessProber, measure_latency
+from report import get_report, phase
+from streaming import StreamingRemote
+from utils import LatencyRegression
+
+
+# Run on the remote with old and new repository paths as arguments. Copies
+# modification times of files not changed between the repositories' HEADs.
+COPY_UNCHANGED_MTIMES = """
+import os, subprocess, sys
+old, new = (os.fsencode(path) for path in sys.argv[1:3])
+def git(*args):
+    return subprocess.check_output(("git", "-C") + args).split(b"\\0")
+old_head = git(old, "rev-parse", "HEAD")[0].strip()
+changed = set(git(new, "diff", "--name-only", "-z", old_head, "HEAD"))
+for name in git(new, "ls-files", "-z"):
+    if name and name not in changed:
+        try:
+            st = os.stat(os.path.join(old, name))
+        except OSError:
+            continue
+        os.utime(os.path.join(new, name), ns=(st.st_atime_ns, st.st_mtime_ns))
+"""
+
+# Run on the remote under flock with manifest path and JSON of changes
+# ({"update": {version: fields}, "remove": [versions]}) as arguments. An
+# unreadable manifest is replaced, the new one is written to a unique
+# temporary file and renamed over it.
+UPDATE_MANIFEST = """
+import json, os, sys, tempfile
+path, changes = sys.argv[1], json.loads(sys.argv[2])
+try:
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest.get("versions"), dict):
+        raise ValueError("no versions")
+except FileNotFoundError:
+    manifest = {"versions": {}}
+except (ValueError, AttributeError) as e:
+    print("Unreadable manifest {} ({}), starting a new one".format(path, e),
+          file=sys.stderr)
+    manifest = {"versions": {}}
+for version, fields in changes["update"].items():
+    manifest["versions"].setdefault(version, {}).update(fields)
+for version in changes["remove"]:
+    manifest["versions"].pop(version, None)
+fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+with os.fdopen(fd, "w") as f:
+    json.dump(manifest, f, sort_keys=True)
+os.chmod(tmp, 0o644)
+os.replace(tmp, path)
+"""
+
+# Run by manage.py shell of a new version before the cutover
+IMPORT_WARMUP = """
+from django.apps import apps
+from django.urls import get_resolver
+apps.get_models()
+get_resolver().url_patterns
+"""
+
+
+class CountingMixin:
+    """
+    Counts run and streamed commands and bytes of commands and their output
+    in a DeployReport
+    """
+    report = None
+
+    def run(self, command, **kwargs):
+        return self._counted(super().run, command, **kwargs)
+
+    def stream(self, command, **kwargs):
+        """
+        Runs command like run. With stream_output set its output is logged
+        line by line as it arrives and the Result keeps only the last
+        stream_tail_lines lines, so use it only for commands with unused
+        output.
+        """
+        if not self.config.stream_output:
+            return self.run(command, **kwargs)
+        # Streamed output is counted as it arrives, the Result has only a tail
+        return self._counted(self._stream, command, count_output=False,
+                             **kwargs)
+
+    def _counted(self, run, command, count_output=True, **kwargs):
+        if self.report is None:
+            return run(command, **kwargs)
+        self.report.count_command()
+        result = run(command, **kwargs)
+        self.report.count_bytes(len(command))
+        if count_output:
+            self.report.count_bytes(len(result.stdout) + len(result.stderr))
+        return result
+
+
+class CountedConnection(CountingMixin, Connection):
+
+    def _stream(self, command, **kwargs):
+        self.open()
+        return self._run(StreamingRemote(context=self,
+                                         inline_env=self.inline_ssh_env),
+                         command, **kwargs)
+
+
+class SudoConnection(CountedConnection):
+    """
+    Runs commands as another user with sudo over the SSH transport of an
+    already opened connection. Each command still gets its own channel, but
+    there is no additional SSH handshake.
+    """
+
+    def __init__(self, connection, user):
+        super().__init__(host=connection.host, user=connection.user,
+                         port=connection.port, config=connection.config)
+        connection.open()
+        self.sudo_user = user
+        self.client = connection.client
+        self.transport = connection.transport
+
+    def _prefix_commands(self, command):
+        return "sudo -n -H -u {} bash -lc {}".format(
+            q(self.sudo_user), q(super()._prefix_commands(command)))
+
+    def close(self):
+        # The transport is owned by the parent connection
+        pass
 
 
 class DjangoConnection:
+    # Instances by host, reused across tasks of a single fab invocation
+    instances = {}
+    # Replaced by a local stand-in in benchmark.py
+    connection_class = CountedConnection
 
     def __init__(self, config):
         self.c = config
+        self.report = get_report(config.host)
 
         logger.info("Connecting to {}".format(config.host))
-        self.c_adm = Connection(host=config.host, user=self.c.admin_username,
-                                config=config)
-        self.c_usr = Connection(host=config.host, user=self.c.app_username, config=config)
+        self.c_adm = self._connect(self.c.admin_username)
+        self.c_usr = self._connect(self.c.app_username)
         assert (self.c_adm.run('whoami').stdout.strip() == self.c.admin_username)
         assert (self.c_usr.run('whoami').stdout.strip() == self.c.app_username)
 
     @staticmethod
     def get_instance(config):
-        if "s" in config:
-            return config.s
-        else:
+        s = DjangoConnection.instances.get(config.host)
+        if s is None or not s.is_alive():
             s = DjangoConnection(config)
-            config.s = s
-            return s
+            DjangoConnection.instances[config.host] = s
+        return s
+
+    def is_alive(self):
+        return self.c_adm.is_connected and self.c_usr.is_connected
+
+    def _connect(self, user):
+        """
+        Opens connection as the given user. With single_connection set,
+        connections other than the admin one are run with sudo over the
+        admin connection transport.
+        """
+        if self.c.single_connection and user != self.c.admin_username:
+            connection = SudoConnection(self.c_adm, user)
+        else:
+            connection = self.connection_class(host=self.c.host, user=user,
+                                               config=self.c)
+        connection.report = self.report
+        return connection
+
+    def _run_parallel(self, cwd, jobs):
+        """
+        Runs jobs - tuples (function, args...) - concurrently in cwd. Each job
+        gets its own app user connection as the first argument.
+
+        Waits for all jobs to finish and raises the first exception.
+        """
+        def run_job(job):
+            c_usr = self._connect(self.c.app_username)
+            try:
+                with c_usr.cd(cwd):
+                    return job[0](c_usr, *job[1:])
+            finally:
+                c_usr.close()
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(run_job, job) for job in jobs]
+        return [future.result() for future in futures]
 
     def prepare_version(self, path, code_commit, config_commit):
+        """
+        Creates version directory at path. On failure the directory is
+        removed.
+        """
         logger.info("Creating code and config files at {}".format(path))
         self.c_usr.run("mkdir {}".format(path))
-        with self.c_usr.cd(path):
-            self.c_usr.run("mkdir {}".format(self.c.static_subdir))
-            # Download code
-            self._download_repository(self.c.code_repo_url, self.c.code_subdir,
-                                      code_commit, self.c.code_branch)
-
-            # Download config
-            self._download_repository(self.c.config_repo_url, self.c.config_subdir,
-                                      config_commit, self.c.config_branch)
-
-            # Prepare venv
-            logger.info("Creating virtualenv")
-            self.c_usr.run("python -m venv {}".format(q(self.c.venv_subdir)))
-            with self.c_usr.prefix("source {}/{}/bin/activate"
-                                   .format(path, q(self.c.venv_subdir))):
-                if self.c.build_script is None:
-                    code_requirements = self.c.code_subdir + "/requirements.txt"
-                    if os.path.isfile(code_requirements):
-                        self.c_usr.run("pip install -r " + q(code_requirements))
-                    config_requirements = self.c.config_subdir + "/requirements.txt"
-                    if os.path.isfile(config_requirements):
-                        self.c_usr.run("pip install -r " + q(config_requirements))
-                else:
-                    self.c_usr.run(self.c.build_script)
-
-    def _download_repository(self, url, path, commit, branch):
+        try:
+            with self.c_usr.cd(path):
+                self.c_usr.run("mkdir {}".format(self.c.static_subdir))
+            # Download code and config, create empty venv
+            with self.report.phase("clone"):
+                self._run_parallel(path, [
+                    (self._download_repository, self.c.code_repo_url,
+                     self.c.code_subdir, code_commit, self.c.code_branch),
+                    (self._download_repository, self.c.config_repo_url,
+                     self.c.config_subdir, config_commit,
+                     self.c.config_branch),
+                    (self._create_venv,),
+                ])
+            with self.c_usr.cd(path):
+                # Prepare venv
+                self._prepare_venv(path)
+                if self.c.incremental_static:
+                    self._reuse_static()
+                if self.c.precompile:
+                    self._precompile()
+        except Exception:
+            logger.info("Removing unfinished version {}".format(path))
+            self.c_usr.run("rm -rf {}".format(path), warn=True)
+            raise
+
+    @phase("transfer")
+    def receive_version(self, builder, build_path, path):
+        """
+        Copies version directory build_path of builder (DjangoConnection of
+        the build host) to path. rsync runs on the build host, files
+        unchanged (by size and modification time, or by content with
+        build_rsync_checksum) since the current version are hardlinked to it
+        instead of being sent. On failure the directory is removed.
+
+        Absolute paths of the build host's version directory (in the
+        virtualenv) and git mirrors (in git alternates) are rewritten to the
+        ones of this host.
+        """
+        logger.info("Transferring {} from {}".format(build_path,
+                                                     builder.c.host))
+        self.c_usr.run("mkdir {}".format(path))
+        try:
+            build_dir, build_mirrors = builder.get_absolute_paths(build_path)
+            target_dir, target_mirrors = self.get_absolute_paths(path)
+            current = self._get_link_target(self.c.current_main)
+            link_dest = ""
+            if self.c_usr.run("test -d {}".format(q(current)), warn=True).ok:
+                link_dest = "--link-dest={} ".format(q(current))
+            checksum = "--checksum " if self.c.build_rsync_checksum else ""
+            builder.c_usr.stream("rsync -aH {}{}{}/ {}".format(
+                checksum, link_dest, q(build_dir),
+                q("{}:{}/".format(self.c.host, target_dir))))
+            batch = CommandBatch(self.c_usr)
+            rewrites = [
+                (build_dir, target_dir, [self.c.venv_subdir]),
+                (build_mirrors, target_mirrors,
+                 [subdir + "/.git/objects/info/alternates"
+                  for subdir in (self.c.code_subdir, self.c.config_subdir)]),
+            ]
+            for old, new, files in rewrites:
+                if old != new:
+                    batch.add("grep -rlIZF {} {} | xargs -0 -r sed -i {}"
+                              .format(q(old), " ".join(
+                                  q(target_dir + "/" + f) for f in files),
+                                  q("s|{}|{}|g".format(old, new))))
+            batch.run()
+        except Exception:
+            logger.info("Removing unfinished version {}".format(path))
+            self.c_usr.run("rm -rf {}".format(path), warn=True)
+            raise
+
+    def get_absolute_paths(self, path):
+        """
+        Returns absolute paths of the existing directory path and of
+        mirrors_dir
+        """
+        return self.c_usr.run(
+            "cd {} && pwd -P && mkdir -p {mirrors} && cd {mirrors} && pwd -P"
+            .format(path, mirrors=self.c.mirrors_dir)).stdout.split("\n")[:2]
+
+    def _create_venv(self, c_usr):
+        logger.info("Creating virtualenv")
+        c_usr.run("python -m venv {}".format(q(self.c.venv_subdir)))
+
+    @phase("venv build")
+    def _prepare_venv(self, path):
+        """
+        Replaces the empty virtualenv with one of a previous version built
+        from the same requirements or installs the requirements.
+        """
+        venv_hash = self._get_venv_hash()
+        cached_version = None
+        if self.c.venv_cache:
+            cached_version = self._find_cached_venv(venv_hash)
+        if cached_version is not None:
+            logger.info("Reusing virtualenv of {}".format(cached_version))
+            self.c_usr.run("rm -rf {}".format(q(self.c.venv_subdir)))
+            self._clone_venv(self.c.versions_dir + "/" + q(cached_version))
+        else:
+            self._install_requirements(path)
+        self.c_usr.run("echo {} {} >> {}".format(
+            venv_hash, q(os.path.basename(path)), self.c.venv_index_file))
+
+    def _install_requirements(self, path):
+        logger.info("Installing virtualenv requirements")
+        with self.c_usr.prefix("source {}/{}/bin/activate"
+                               .format(path, q(self.c.venv_subdir))):
+            if self.c.build_script is None:
+                for subdir in (self.c.code_subdir, self.c.config_subdir):
+                    requirements = subdir + "/requirements.txt"
+                    if self.c_usr.run("test -f " + q(requirements),
+                                      warn=True).ok:
+                        self.c_usr.stream("pip install -r "
+                                          + q(requirements))
+            else:
+                self.c_usr.stream(self.c.build_script)
+
+    @phase("static")
+    def _reuse_static(self):
+        """
+        Hardlinks static files of the current version into the current
+        directory. Modification times of code and config files unchanged
+        since the current version are copied from it, so collectstatic run by
+        install_script skips files that did not change.
+        """
+        current = self._get_link_target(self.c.current_main)
+        static = q(self.c.static_subdir)
+        if not self.c_usr.run("test -d {}/{}".format(q(current), static),
+                              warn=True).ok:
+            return
+        logger.info("Reusing static files of {}".format(current))
+        # Failures only cost a full collectstatic, so they are not fatal
+        batch = CommandBatch(self.c_usr, stop_on_error=False)
+        batch.add("cp -al {}/{}/. {}/".format(q(current), static, static))
+        for subdir in (self.c.code_subdir, self.c.config_subdir):
+            batch.add("python -c {} {} {}".format(
+                q(COPY_UNCHANGED_MTIMES), q(current + "/" + subdir), q(subdir)))
+        for result in batch.run(warn=True):
+            if not result.ok:
+                logger.warning("Reusing static files partially failed: {}\n{}"
+                               .format(result.command, result.stdout))
+
+    @phase("precompile")
+    def _precompile(self):
+        """
+        Compiles Python files of code, config and virtualenv to bytecode in
+        the current directory with a process per CPU, so the App's workers do
+        not compile them on the first requests. Failures (e.g. files with
+        syntax of another Python version) are only logged.
+        """
+        logger.info("Compiling Python files")
+        result = self.c_usr.run(
+            "nice {}/bin/python -m compileall -q -j 0 {} {} {}".format(
+                q(self.c.venv_subdir), q(self.c.code_subdir),
+                q(self.c.config_subdir), q(self.c.venv_subdir)), warn=True)
+        if not result.ok:
+            logger.warning("Some Python files failed to compile")
+
+    def _get_venv_hash(self):
+        """
+        Hash of everything the virtualenv is built from: Python version,
+        build script and requirement files (or venv_cache_inputs)
+        """
+        inputs = self.c.venv_cache_inputs
+        if inputs is None:
+            inputs = [self.c.code_subdir + "/requirements.txt",
+                      self.c.config_subdir + "/requirements.txt"]
+        return self.c_usr.run(
+            "{{ python --version; echo {}; tail -n +1 -- {} 2>/dev/null; }} "
+            "| sha256sum".format(q(str(self.c.build_script)),
+                                 " ".join(q(i) for i in inputs))
+        ).stdout.split()[0]
+
+    def _find_cached_venv(self, venv_hash):
+        index = self.c_usr.run("cat {}".format(self.c.venv_index_file),
+                               warn=True).stdout.splitlines()
+        for line in reversed(index):
+            elements = line.split()
+            if len(elements) != 2 or elements[0] != venv_hash:
+                continue
+            venv = "{}/{}/{}".format(self.c.versions_dir, q(elements[1]),
+                                     q(self.c.venv_subdir))
+            if self.c_usr.run("test -d {}".format(venv), warn=True).ok:
+                return elements[1]
+        return None
+
+    def _clone_venv(self, version_path):
+        """
+        Hardlinks virtualenv of given version into the current directory.
+
+        Virtualenvs contain absolute paths (activate scripts, shebangs), these
+        are rewritten. sed replaces files, so the source venv is not modified.
+        """
+        self.c_usr.run(
+            'old="$(cd {old} && pwd -P)" && new="$(pwd -P)" && '
+            'cp -al "$old/{venv}" {venv} && '
+            'grep -rlIZF "$old" {venv} | xargs -0 -r sed -i "s|$old|$new|g"'
+            .format(old=version_path, venv=q(self.c.venv_subdir)))
+
+    def _download_repository(self, c_usr, url, path, commit, branch):
         logger.info("Downloading repository {} to {}, commit {}"
                      .format(url, path, commit))
-        self.c_usr.run("git clone {} {}".format(q(url), q(path)))
-        with self.c_usr.cd(path):
-            self.c_usr.run("git checkout {}".format(q(commit)))
-            self.c_usr.run("git branch -D master")
-            self.c_usr.run("git checkout -b {}".format(branch))
-            self.c_usr.run(
+        mirror = self._update_mirror(c_usr, url, commit)
+        # Objects are shared with the mirror, so only the checkout is written
+        c_usr.stream("git clone --shared {} {}".format(mirror, q(path)))
+        with c_usr.cd(path):
+            c_usr.run("git remote set-url origin {}".format(q(url)))
+            c_usr.run("git checkout {}".format(q(commit)))
+            c_usr.run("git branch -D master")
+            c_usr.run("git checkout -b {}".format(branch))
+            c_usr.run(
                 "git branch --set-upstream-to=origin/{}".format(branch))
 
+    def _update_mirror(self, c_usr, url, commit=None):
+        """
+        Creates or incrementally updates a bare mirror of the repository.
+        Fetching is skipped if the mirror already contains given commit hash.
+
+        Version directories reference objects of the mirror (git alternates),
+        so mirrors must never be deleted or garbage collected.
+        """
+        mirror = "{}/{}.git".format(self.c.mirrors_dir,
+                                    re.sub(r"[^\w.-]", "_", url))
+        if commit is not None and re.fullmatch(r"[0-9a-f]{7,40}", commit) \
+                and c_usr.run("git --git-dir {} cat-file -e {}^{{commit}}"
+                              .format(mirror, commit), warn=True).ok:
+            return mirror
+        if c_usr.run("test -d {}".format(mirror), warn=True).ok:
+            logger.info("Fetching {} into {}".format(url, mirror))
+            c_usr.stream("flock {0}.lock git --git-dir {0} fetch origin"
+                         .format(mirror))
+        else:
+            logger.info("Creating mirror of {} at {}".format(url, mirror))
+            c_usr.run("mkdir -p {}".format(self.c.mirrors_dir))
+            # Another deploy or prebuild may have created it meanwhile
+            c_usr.stream("flock {0}.lock sh -c {1}".format(mirror, q(
+                "test -d {0} || git clone --mirror --config gc.auto=0 {1} {0}"
+                .format(mirror, q(url)))))
+        return mirror
+
+    def _resolve_commit(self, c_usr, url, commit):
+        mirror = self._update_mirror(c_usr, url, commit)
+        return c_usr.run("git --git-dir {} rev-parse --verify {}".format(
+            mirror, q(commit + "^{commit}"))).stdout.strip()
+
+    def resolve_commits(self, code_commit, config_commit):
+        """
+        Returns full hashes of given (possibly abbreviated) code and config
+        commits
+        """
+        return self._run_parallel(self.c.versions_dir, [
+            (self._resolve_commit, self.c.code_repo_url, code_commit),
+            (self._resolve_commit, self.c.config_repo_url, config_commit),
+        ])
+
+    def read_manifest(self):
+        """
+        Returns the versions manifest - a dict with "versions" dict of version
+        names to their metadata
+        """
+        return self._parse_manifest(self.c_usr.run(
+            "cat {} 2>/dev/null || true".format(self.c.manifest_file)).stdout)
+
+    @staticmethod
+    def _parse_manifest(text):
+        """
+        Parses the manifest, an unreadable one is treated as empty
+        """
+        if not text.strip():
+            return {'versions': {}}
+        try:
+            manifest = json.loads(text)
+            if not isinstance(manifest.get('versions'), dict):
+                raise ValueError("no versions")
+        except (ValueError, AttributeError) as e:
+            logger.warning("Ignoring unreadable versions manifest: {}"
+                           .format(e))
+            return {'versions': {}}
+        return manifest
+
+    def _change_manifest(self, update=None, remove=()):
+        """
+        Updates fields of versions in the manifest and removes versions from
+        it. Changes are serialized with flock on the host, so concurrent
+        deploys and prebuilds do not overwrite each other's changes.
+        """
+        changes = {'update': update or {}, 'remove': list(remove)}
+        self.c_usr.run("flock {file}.lock python -c {script} {file} {changes}"
+                       .format(file=self.c.manifest_file,
+                               script=q(UPDATE_MANIFEST),
+                               changes=q(json.dumps(changes))))
+
+    def update_manifest(self, version, **fields):
+        self._change_manifest(update={version: fields})
+
+    def remove_from_manifest(self, versions):
+        self._change_manifest(remove=versions)
+
+    def record_build(self, path, code_commit, config_commit, build_duration):
+        """
+        Adds a newly built version at path to the manifest
+        """
+        size = int(self.c_usr.run("du -sb {}".format(path)).stdout.split()[0])
+        self.update_manifest(os.path.basename(path), code=code_commit,
+                             config=config_commit,
+                             created=datetime.datetime.now().isoformat(),
+                             build_duration=build_duration, size=size,
+                             status="built")
+
+    def find_version(self, code_commit, config_commit):
+        """
+        Returns name of the newest existing version built from given full
+        commit hashes or None
+        """
+        versions = self.read_manifest()['versions']
+        for version in sorted(versions, reverse=True):
+            entry = versions[version]
+            if entry.get('code') != code_commit \
+                    or entry.get('config') != config_commit:
+                continue
+            path = self.c.versions_dir + "/" + q(version)
+            batch = CommandBatch(self.c_usr)
+            batch.add("git -C {}/{} rev-parse HEAD".format(
+                path, q(self.c.code_subdir)))
+            batch.add("git -C {}/{} rev-parse HEAD".format(
+                path, q(self.c.config_subdir)))
+            batch.add("test -x {}/{}/bin/python".format(
+                path, q(self.c.venv_subdir)))
+            results = batch.run(warn=True)
+            if [result.stdout.strip() for result in results[:2]] \
+                    == [code_commit, config_commit] \
+                    and len(results) == 3 and results[2].ok:
+                return version
+            logger.warning("Version {} failed verification".format(version))
+        return None
+
     def stop_maintenance(self):
         logger.info("Stopping maintenance mode")
         self.c_adm.run(self.c.maintenance_stop_script)
@@ -76,24 +550,88 @@ class DjangoConnection:
         logger.info("Starting maintenance mode")
         self.c_adm.run(self.c.maintenance_start_script)
 
+    @phase("start")
     def start_django(self):
         self.stop_maintenance()
         logger.info("Starting the App")
         self.c_adm.run("sudo systemctl start -la " + self.c.systemd_service)
 
+    @phase("stop")
     def stop_django(self):
         """
         Stop the Django App, but we don't fail if already stopped
         """
         logger.info("Stopping django")
+        self.report.mark_down()
         self.c_adm.run("sudo systemctl stop -la " + self.c.systemd_service)
 
+    @phase("backup")
     def backup_database(self):
         logger.info("Backing up database")
-        filepath = self.c_adm.run(self.c.backup_script).stdout.strip()
-        assert int(self.c_adm.run('stat --printf="%s" {}'.format(
-            filepath)).stdout) > 100 * 1000  # 100kB
+        start = time.monotonic()
+        if self.c.backup_stream_command is None:
+            filepath = self.c_adm.run(self.c.backup_script).stdout.strip()
+        else:
+            filepath = self._stream_backup()
+        duration = time.monotonic() - start
+        size = int(self.c_adm.run('stat --printf="%s" {}'.format(
+            filepath)).stdout)
+        assert size > 100 * 1000  # 100kB
+        logger.info("Backup {} of {} bytes took {:.1f}s".format(
+            filepath, size, duration))
+        stats = {
+            'path': filepath,
+            'bytes': size,
+            'duration': duration,
+            'throughput': size / duration if duration else None,
+        }
+        if self.c.backup_stream_command is not None:
+            start = time.monotonic()
+            self._verify_backup(filepath)
+            stats['verify_duration'] = time.monotonic() - start
+        self.report.record('backup', stats)
+
+    def _stream_backup(self):
+        """
+        Compresses output of backup_stream_command with pigz (gzip if pigz is
+        not installed) into a new file in backup_dir. SHA-256 of the file is
+        computed while it is written and saved next to it in sha256sum -c
+        format. Returns path of the file.
+        """
+        name = "db-{}.gz".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        filepath = "{}/{}".format(self.c.backup_dir, name)
+        self.c_adm.run(
+            "set -o pipefail && mkdir -p {dir} && "
+            "{{ {command}; }} | $(command -v pigz || echo gzip) -c "
+            "| tee {file} | sha256sum | sed {sed} > {file}.sha256 "
+            "|| {{ rm -f {file} {file}.sha256; exit 1; }}".format(
+                dir=self.c.backup_dir, command=self.c.backup_stream_command,
+                file=filepath, sed=q("s|-$|{}|".format(name))))
+        return filepath
+
+    def _verify_backup(self, filepath):
+        """
+        Checks the written file against the SHA-256 computed while writing it
+        and tests integrity of the compressed data
+        """
+        logger.info("Verifying backup {}".format(filepath))
+        self.c_adm.run(
+            "cd {dir} && sha256sum --quiet -c {name}.sha256 && "
+            "$(command -v pigz || echo gzip) -t {name}".format(
+                dir=os.path.dirname(filepath),
+                name=q(os.path.basename(filepath))))
+
+    @phase("backup catchup")
+    def backup_catchup(self):
+        """
+        Runs backup_catchup_script completing the backup made before the App
+        was stopped
+        """
+        logger.info("Running backup catch-up")
+        self.c_adm.run(self.c.backup_catchup_script)
 
+    @phase("hotfix check")
     def check_for_uncommited_changes(self):
         logger.info("Checking for uncommited or unpushed changes")
         self._check_repository(self.c.current_code)
@@ -107,11 +645,10 @@ class DjangoConnection:
             # Checked for unpushed commits
             assert "" == self.c_usr.run("git log @{u}..").stdout.strip()
 
+    @phase("cutover")
     def change_codebase(self, new_path):
         logger.info("Changing codebase to {}".format(new_path))
-        self.c_usr.run("rm -f {}".format(self.c.previous_main))
-        self.c_usr.run("mv {} {}".format(self.c.current_main, self.c.previous_main))
-        self.c_usr.run("ln -s {} {}".format(q(new_path), self.c.current_main))
+        self._swap_link(new_path, self.c.current_main, self.c.previous_main)
 
     def change_to_previous_codebase(self):
         self.change_codebase(self.get_previous_version())
@@ -119,11 +656,25 @@ class DjangoConnection:
     def mark_working(self, new_path):
         if new_path == self.get_working_version():
             return
-        self.c_usr.run("rm -f {}".format(self.c.previous_working))
-        self.c_usr.run(
-            "mv {} {}".format(self.c.current_working, self.c.previous_working))
-        self.c_usr.run("ln -s {} {}".format(q(new_path), self.c.current_working))
+        self._swap_link(new_path, self.c.current_working,
+                        self.c.previous_working)
+        # The working version is shown by its symlink, the status only
+        # records that the version was deployed successfully
+        self.update_manifest(os.path.basename(new_path), status="deployed",
+                             deployed=datetime.datetime.now().isoformat())
+
+    def _swap_link(self, new_path, link, previous_link):
+        """
+        Points link to new_path and previous_link to the old target of link
+        in a single remote script
+        """
+        batch = CommandBatch(self.c_usr)
+        batch.add("rm -f {}".format(previous_link))
+        batch.add("mv {} {}".format(link, previous_link))
+        batch.add("ln -s {} {}".format(q(new_path), link))
+        batch.run()
 
+    @phase("check")
     def django_check_manage(self):
         """
         Checks if manage.py succeeds to run without exceptions.
@@ -137,32 +688,158 @@ class DjangoConnection:
             with self.c_usr.cd(self.c.deployment_dir):
                 self.c_usr.run("./manage.py")
 
+    @phase("migrate")
     def django_migrations(self):
         logger.info("Applying Django migrations")
         with self.c_usr.prefix(
                 "source {}/bin/activate".format(self.c.current_venv_dir)):
             with self.c_usr.cd(self.c.deployment_dir):
-                self.c_usr.run("./manage.py migrate --no-input")
+                self.c_usr.stream("./manage.py migrate --no-input")
+
+    def _run_in_version(self, path, command, **kwargs):
+        """
+        Runs command in the config directory of version at path with its
+        virtualenv activated, without touching the django-current symlink
+        """
+        with self.c_usr.prefix("source {}/{}/bin/activate"
+                               .format(path, q(self.c.venv_subdir))):
+            with self.c_usr.cd("{}/{}".format(path, q(self.c.config_subdir))):
+                return self.c_usr.run(command, **kwargs)
 
+    @phase("preflight")
+    def django_preflight(self, path):
+        """
+        Runs manage.py check and preflight_script for version at path while
+        the current version keeps running.
+
+        preflight_script gets the version directory in DEPLOY_VERSION_DIR and
+        must not modify the running version (e.g. collect static files into
+        $DEPLOY_VERSION_DIR/static, not to STATIC_ROOT).
+        """
+        logger.info("Running preflight checks of {}".format(path))
+        self._run_in_version(path, "./manage.py check")
+        if self.c.preflight_script is not None:
+            with self.c_usr.prefix('export DEPLOY_VERSION_DIR="$(cd {} && '
+                                   'pwd -P)"'.format(path)):
+                self._run_in_version(path, self.c.preflight_script)
+
+    @phase("warmup")
+    def django_import_warmup(self, path):
+        """
+        Imports Django apps, models and the URLconf of version at path, so
+        its files are in the page cache when the App starts. Failure is only
+        logged.
+        """
+        logger.info("Warming up imports of {}".format(path))
+        result = self._run_in_version(
+            path, "./manage.py shell -c {}".format(q(IMPORT_WARMUP)),
+            warn=True)
+        if not result.ok:
+            logger.warning("Import warm-up failed")
+
+    @phase("migration plan")
+    def django_migration_plan(self, path):
+        """
+        Returns list of migrations pending for version at path or None if
+        the plan can't be computed
+        """
+        logger.info("Computing migration plan")
+        result = self._run_in_version(
+            path, "./manage.py migrate --plan --no-input", warn=True)
+        if not result.ok:
+            logger.warning("Failed to compute migration plan")
+            return None
+        plan = [line.strip() for line in result.stdout.splitlines()
+                if line.strip() and not line[0].isspace()
+                and line.strip() != "Planned operations:"]
+        logger.info("Pending migrations: {}".format(", ".join(plan) or "none"))
+        self.report.record('migration_plan', plan)
+        return plan
+
+    @phase("install")
     def django_perform_install(self):
         if self.c.install_script is not None:
             logger.info("Performing Django version install")
             with self.c_usr.prefix(
                     "source {}/bin/activate".format(self.c.current_venv_dir)):
                 with self.c_usr.cd(self.c.deployment_dir):
-                    self.c_usr.run(self.c.install_script)
+                    self.c_usr.stream(self.c.install_script)
 
+    @phase("health check")
     def check_app_works(self):
-        logger.info("Testing connection to {}".format(self.c.website_url))
-        r = requests.get(self.c.website_url)
-        count = 0
-        # Starting of Django App may take some time.
-        while not r.ok and count < 60:
-            logger.debug("Waiting for the App start...")
-            time.sleep(1)
-            r = requests.get(self.c.website_url)
-            count += 1
-        assert r.ok
+        urls = self._host_urls(self.c.probe_urls or [self.c.website_url])
+        logger.info("Testing connection to {}".format(", ".join(urls)))
+        prober = ReadinessProber(urls, timeout=self.c.probe_timeout,
+                                 deadline=self.c.probe_deadline,
+                                 interval=self.c.probe_interval,
+                                 max_interval=self.c.probe_max_interval)
+        start = time.monotonic()
+        try:
+            # Starting of Django App may take some time.
+            ok_at = prober.wait()
+        finally:
+            prober.close()
+        assert ok_at is not None
+        logger.info("The App responded after {:.3f}s".format(ok_at - start))
+        self.report.record('time_to_first_ok', ok_at - start)
+        self.report.mark_up(ok_at)
+
+    def _host_urls(self, urls):
+        """
+        URLs with {host} replaced by the host, so that a host can be probed
+        directly instead of through a load balancer
+        """
+        return [url.replace("{host}", self.c.host) for url in urls]
+
+    @phase("latency check")
+    def measure_latency(self):
+        """
+        Measures latency of load_probe_urls, returns None if not configured
+        """
+        if not self.c.load_probe_urls:
+            return None
+        urls = self._host_urls(self.c.load_probe_urls)
+        logger.info("Measuring latency of {}".format(", ".join(urls)))
+        stats = measure_latency(urls,
+                                self.c.load_probe_requests,
+                                self.c.load_probe_concurrency,
+                                warmup=self.c.load_probe_warmup,
+                                timeout=self.c.probe_timeout)
+        logger.info("Latency p50 {p50}, p95 {p95}, p99 {p99}, error rate "
+                    "{error_rate}".format(**stats))
+        self.report.record('latency', stats)
+        return stats
+
+    def check_latency(self, stats, baseline):
+        """
+        Raises LatencyRegression if error rate exceeds latency_max_error_rate
+        or any percentile exceeds baseline percentile times
+        latency_regression_threshold
+        """
+        if stats['error_rate'] > self.c.latency_max_error_rate:
+            raise LatencyRegression("Error rate {} exceeds {}".format(
+                stats['error_rate'], self.c.latency_max_error_rate))
+        if baseline is None:
+            return
+        for key in ('p50', 'p95', 'p99'):
+            if baseline.get(key) is None:
+                continue
+            limit = baseline[key] * self.c.latency_regression_threshold
+            if stats[key] > limit:
+                raise LatencyRegression(
+                    "Latency {} {:.3f}s exceeds {:.3f}s (baseline {:.3f}s)"
+                    .format(key, stats[key], limit, baseline[key]))
+
+    def get_latency_baseline(self, version):
+        result = self.c_usr.run("cat {}/{}/latency.json".format(
+            self.c.versions_dir, q(version)), warn=True)
+        if not result.ok:
+            return None
+        return json.loads(result.stdout)
+
+    def save_latency_baseline(self, version, stats):
+        self.c_usr.run("printf %s {} > {}/{}/latency.json".format(
+            q(json.dumps(stats)), self.c.versions_dir, q(version)))
 
     def get_current_version(self):
         return self._get_link_target_basename(self.c.current_main)
@@ -182,42 +859,143 @@ class DjangoConnection:
     def _get_link_target(self, link):
         return self.c_usr.run("readlink -f {}".format(link)).stdout.strip()
 
+    def get_versions_state(self):
+        """
+        Returns list of available versions, a dict of versions pointed to by
+        symlinks (current, previous, working, working-old) and the versions
+        manifest using a single round-trip
+        """
+        links = {
+            'current': self.c.current_main,
+            'previous': self.c.previous_main,
+            'working': self.c.current_working,
+            'working-old': self.c.previous_working,
+        }
+        batch = CommandBatch(self.c_usr)
+        batch.add("cat {} 2>/dev/null || true".format(self.c.manifest_file))
+        batch.add("ls -1 " + self.c.versions_dir)
+        for link in links.values():
+            batch.add("readlink -f {}".format(link))
+        results = batch.run()
+        manifest = self._parse_manifest(results[0].stdout)
+        versions = self._parse_versions(results[1].stdout)
+        tagged = {tag: os.path.basename(result.stdout.strip())
+                  for tag, result in zip(links, results[2:])}
+        return versions, tagged, manifest
+
     def delete_version(self, path):
-        if path not in self.list_versions():
+        versions_list, tagged, _ = self.get_versions_state()
+        if path not in versions_list:
             raise Exception("Not an available version")
-        if os.path.basename(path) in self.get_protected_versions():
+        if os.path.basename(path) in tagged.values():
             raise Exception("Refusing to delete protected version")
-        logger.info("Deleting {}".format(q(self.c.versions_dir + "/" + path)))
-        self.c_usr.run("rm -rf {}".format(q(self.c.versions_dir + "/" + path)))
+        if not self._trash_versions([path]):
+            raise Exception("Failed to delete version {}".format(path))
 
     def delete_versions(self, to_delete):
-        versions_list = self.list_versions()
-        protected_versions = self.get_protected_versions()
+        versions_list, tagged, _ = self.get_versions_state()
+        deleted = []
         for path in to_delete:
             if path not in versions_list:
                 logger.error("Not an available version: {}".format(path))
                 continue
-            if os.path.basename(path) in protected_versions:
+            if os.path.basename(path) in tagged.values():
                 logger.warning(
                         "Refusing to delete protected version: {}".format(path))
                 continue
-            logger.info("Deleting {}".format(q(self.c.versions_dir + "/" + path)))
-            self.c_usr.run("rm -rf {}".format(q(self.c.versions_dir + "/" + path)))
+            deleted.append(path)
+        if deleted:
+            self._trash_versions(deleted)
+
+    def _trash_versions(self, versions):
+        """
+        Atomically moves version directories to trash_dir and removes them
+        in a low priority background process. Returns versions which were
+        moved, only these are removed from the manifest.
+        """
+        suffix = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        batch = CommandBatch(self.c_usr, stop_on_error=False)
+        batch.add("mkdir -p {}".format(self.c.trash_dir))
+        moves = {}
+        for version in versions:
+            logger.info("Deleting {}".format(version))
+            command = "mv {}/{} {}/{}".format(
+                self.c.versions_dir, q(version), self.c.trash_dir,
+                q(version + "-" + suffix))
+            moves[command] = version
+            batch.add(command)
+        batch.add("nohup nice -n 19 $(command -v ionice > /dev/null && "
+                  "echo ionice -c 3) rm -rf {}/* > /dev/null 2>&1 < /dev/null &"
+                  .format(self.c.trash_dir))
+        moved = []
+        for result in batch.run(warn=True):
+            if not result.ok:
+                logger.error("Failed: {}\n{}".format(result.command,
+                                                     result.stdout))
+            elif result.command in moves:
+                moved.append(moves[result.command])
+        if moved:
+            self.remove_from_manifest(moved)
+        return moved
+
+    @phase("gc")
+    def collect_garbage(self):
+        """
+        Deletes oldest unprotected versions while there are more than
+        gc_keep versions, they are older than gc_max_age_days, all versions
+        take more than gc_max_total_bytes or there is less than
+        gc_min_free_bytes of free disk space
+        """
+        versions, tagged, manifest = self.get_versions_state()
+        free = int(self.c_usr.run("df -B1 --output=avail {} | tail -n 1"
+                                  .format(self.c.versions_dir)).stdout)
+        sizes = {version: manifest['versions'].get(version, {}).get('size', 0)
+                 for version in versions}
+        total = sum(sizes.values())
+        count = len(versions)
+        now = datetime.datetime.now()
+        to_delete = []
+        for version in sorted(versions):
+            if version in tagged.values():
+                continue
+            try:
+                created = datetime.datetime.strptime(
+                    "-".join(version.split("-")[1:3]), "%Y%m%d-%H%M%S")
+            except ValueError:
+                created = now
+            if count <= self.c.gc_keep \
+                    and (self.c.gc_max_age_days is None or
+                         (now - created).days < self.c.gc_max_age_days) \
+                    and (self.c.gc_max_total_bytes is None or
+                         total <= self.c.gc_max_total_bytes) \
+                    and (self.c.gc_min_free_bytes is None or
+                         free >= self.c.gc_min_free_bytes):
+                break
+            to_delete.append(version)
+            count -= 1
+            total -= sizes[version]
+            # Hardlinked files are not freed, so this is an estimate
+            free += sizes[version]
+        if to_delete:
+            self._trash_versions(to_delete)
+        else:
+            logger.info("No versions to delete")
+        return to_delete
 
     def get_protected_versions(self):
-        return [self.get_current_version(),
-                self.get_previous_version(),
-                self.get_working_version(),
-                self.get_previous_working_version(),
-                ]
+        return list(self.get_versions_state()[1].values())
 
     def list_versions(self):
-        folders = self.c_usr.run("ls -1 " + self.c.versions_dir).stdout.split()
+        return self._parse_versions(
+            self.c_usr.run("ls -1 " + self.c.versions_dir).stdout)
+
+    @staticmethod
+    def _parse_versions(ls_output):
         result = []
-        for folder in folders:
+        for folder in ls_output.split():
             folder = folder.strip()
             elements = folder.split("-")
-            if elements[0] == "django" \
+            if len(elements) > 1 and elements[0] == "django" \
                and elements[1].isnumeric():
                 result.append(folder)
         return result
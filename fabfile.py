@@ -1,12 +1,17 @@
 #!/usr/bin/python3
+from concurrent.futures import ThreadPoolExecutor
 from fabric import task
-from invoke import Collection
+from invoke import Collection, Context
 import invoke.exceptions
 import datetime
+import os
+import threading
+import time
 
 from django_connection import DjangoConnection
-from utils import Fallback, handle_exceptions
+from utils import Fallback, LatencyRegression, handle_exceptions
 from logger import logger
+from report import reported
 
 # Hide a deprecation warning caused by Paramiko code
 import warnings
@@ -20,6 +25,15 @@ ns.configure({
     'venv_subdir': "venv",
     'static_subdir': "static",
     'versions_dir': "~/",
+    'mirrors_dir': "~/mirrors",
+    'venv_index_file': "~/venv-index",
+    'manifest_file': "~/versions.json",
+    'trash_dir': "~/.deleted-versions",
+    'gc_after_deploy': False,
+    'gc_keep': 10,
+    'gc_max_age_days': None,
+    'gc_max_total_bytes': None,
+    'gc_min_free_bytes': None,
     'deployment_dir': "~/deployment",
     'current_venv_dir': "~/venv",
     'current_code': "~/django",
@@ -32,10 +46,44 @@ ns.configure({
     'maintenance_start_script': "~/scripts/start_maintenance.sh",
     'maintenance_stop_script': "~/scripts/stop_maintenance.sh",
     'backup_script': "~/scripts/backup_database.sh",
+    'backup_stream_command': None,
+    'backup_dir': "~/backups",
+    'backup_catchup_script': None,
     'admin_username': "admin",
     'app_username': "app",
+    'single_connection': False,
     'build_script': None,
+    'build_host': None,
+    'build_rsync_checksum': False,
+    'venv_cache': True,
+    'venv_cache_inputs': None,
     'install_script': None,
+    'preflight': True,
+    'preflight_script': None,
+    'migration_plan': True,
+    'skip_backup_without_migrations': False,
+    'incremental_static': False,
+    'precompile': True,
+    'import_warmup': False,
+    'probe_urls': None,
+    'probe_timeout': 5,
+    'probe_deadline': 60,
+    'probe_interval': 0.05,
+    'probe_max_interval': 1,
+    'load_probe_urls': None,
+    'load_probe_requests': 100,
+    'load_probe_concurrency': 10,
+    'load_probe_warmup': 20,
+    'latency_regression_threshold': 1.5,
+    'latency_max_error_rate': 0.0,
+    'latency_rollback': False,
+    'deploy_hosts': None,
+    'rollout_canary': 1,
+    'rollout_batch_size': 2,
+    'stream_output': True,
+    'stream_tail_lines': 100,
+    'report_file': "deploy-report.json",
+    'report_history_file': "deploy-history.jsonl",
 })
 
 
@@ -59,8 +107,13 @@ ns.add_task(check_uncommited)
 
 
 @task(help={'code': "Code commit hash to use",
-            'config': "Config commit hash to use"})
-def create_version(c, code, config):
+            'config': "Config commit hash to use",
+            'reuse': "Reuse an existing version built from the same commits "
+                     "(defaults to yes)",
+            'maintenance': "Run maintenance scripts around the build "
+                           "(defaults to yes)"})
+@reported
+def create_version(c, code, config, reuse=True, maintenance=True):
     """
     Create version
 
@@ -68,32 +121,93 @@ def create_version(c, code, config):
     """
     s = DjangoConnection.get_instance(c.config)
 
-    code_commit = code
-    config_commit = config
+    code_commit, config_commit = s.resolve_commits(code, config)
+    if reuse:
+        existing = s.find_version(code_commit, config_commit)
+        # Reusing the current version would overwrite the previous one
+        if existing is not None and existing != s.get_current_version():
+            logger.info("Reusing existing version {}".format(existing))
+            s.report.record('version', existing)
+            return c.versions_dir + "/" + existing
+
     new_path = c.versions_dir + "/django" \
                + "-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") \
                + "-" + code_commit[:6] \
                + "-" + config_commit[:6]
 
+    start = time.monotonic()
     try:
-        s.start_maintenance()
-        s.prepare_version(new_path, code_commit, config_commit)
+        if maintenance:
+            s.start_maintenance()
+        if c.build_host is None:
+            s.prepare_version(new_path, code_commit, config_commit)
+        else:
+            _build_on_build_host(c, s, new_path, code_commit, config_commit)
     except Exception as e:
         logger.info("Code generation failed!")
         raise Fallback(e)
     finally:
-        s.stop_maintenance()
+        if maintenance:
+            s.stop_maintenance()
+
+    s.record_build(new_path, code_commit, config_commit,
+                   time.monotonic() - start)
+    s.report.record('version', new_path)
 
     return new_path
 ns.add_task(create_version)
 
 
+# Serializes builds of hosts prepared concurrently, so a version is built on
+# the build host once and reused for the other hosts
+_build_lock = threading.Lock()
+
+
+def _build_on_build_host(c, s, new_path, code_commit, config_commit):
+    """
+    Builds the version on build_host, unless one of the same commits exists
+    there, and transfers it to new_path of the host
+    """
+    builder = DjangoConnection.get_instance(
+        _host_context(c, c.build_host).config)
+    with _build_lock:
+        build_name = builder.find_version(code_commit, config_commit)
+        if build_name is None:
+            build_path = new_path
+            start = time.monotonic()
+            builder.prepare_version(build_path, code_commit, config_commit)
+            builder.record_build(build_path, code_commit, config_commit,
+                                 time.monotonic() - start)
+        else:
+            logger.info("Reusing version {} of the build host"
+                        .format(build_name))
+            build_path = c.versions_dir + "/" + build_name
+    s.receive_version(builder, build_path, new_path)
+
+
+@task(help={'code': "Code commit hash to use",
+            'config': "Config commit hash to use"})
+@handle_exceptions
+def prebuild(c, code, config):
+    """
+    Build version ahead of deployment
+
+    Creates Django App version given code and config versions unless one
+    already exists, so that a later deploy of them skips the build. Unlike
+    create_version it does not run the maintenance scripts.
+    """
+    print(os.path.basename(create_version(c, code, config,
+                                          maintenance=False)))
+ns.add_task(prebuild)
+
+
 @task(help={'name': "Instance name / path",
             'migrate': "Perform Django migrations (defaults to yes)",
             'collect-static': "Collect Django static files (defaults to no)",
             'clear_cache': "Clear Django cache (defaults to yes)",
             'compress': "Perform django-compress (defaults to no)"})
 @handle_exceptions
+@reported
 def change_version(c, name, migrate=True, prepare_install=False):
     """
     Change running version
@@ -105,6 +219,12 @@ def change_version(c, name, migrate=True, prepare_install=False):
                         "django-20190505-1800-abcdef-fedcba. Never a path to "
                         "a symlink!".format(name))
 
+    _switch_version(s, name, migrate, prepare_install)
+    _check_latency_and_mark_working(c, s, name)
+ns.add_task(change_version)
+
+
+def _switch_version(s, name, migrate, prepare_install):
     s.stop_django()
     s.change_codebase(name)
 
@@ -116,8 +236,30 @@ def change_version(c, name, migrate=True, prepare_install=False):
     s.start_django()
 
     s.check_app_works()
-    s.mark_working(name)
-ns.add_task(change_version)
+
+
+def _check_latency_and_mark_working(c, s, new_path):
+    """
+    Marks new_path working unless its latency regressed compared to the
+    working version. On regression changes back to the working version if
+    latency_rollback is set.
+    """
+    stats = s.measure_latency()
+    if stats is not None:
+        working_version = s.get_working_version()
+        new_version = os.path.basename(new_path)
+        try:
+            s.check_latency(stats, s.get_latency_baseline(working_version))
+        except LatencyRegression as e:
+            logger.error("Latency regression, not marking {} as working"
+                         .format(new_version))
+            if c.latency_rollback and working_version != new_version:
+                logger.error("Changing back to {}".format(working_version))
+                _switch_version(s, working_version, False, False)
+                raise Fallback(e)
+            raise
+        s.save_latency_baseline(new_version, stats)
+    s.mark_working(new_path)
 
 
 @task
@@ -136,9 +278,15 @@ ns.add_task(restart_django)
             'config': "Config commit hash to use",
             'check-hotfixes': "Check for uncommited or unpushed changes ("
                               "defaults to yes)",
-            'backup': "Backup database (defaults to yes)"})
+            'backup': "Backup database (defaults to yes)",
+            'host-list': "Comma separated hosts to deploy to (defaults to "
+                         "deploy_hosts or host)",
+            'batch-size': "Number of hosts cut over concurrently after the "
+                          "canary (defaults to rollout_batch_size)"})
 @handle_exceptions
-def deploy(c, code, config, check_hotfixes=True, backup=True):
+@reported
+def deploy(c, code, config, check_hotfixes=True, backup=True, host_list=None,
+           batch_size=None):
     """
     the Django App deployment
 
@@ -149,27 +297,70 @@ def deploy(c, code, config, check_hotfixes=True, backup=True):
     4. Makes database backup
     5. Applies django upgrade functions (migrations, etc.)
     6. Starts the Django App
+
+    With multiple hosts steps 1-2 run on all hosts in parallel, steps 3-6
+    first on the canary hosts and then on batches of the rest.
+    """
+    hosts = host_list.split(",") if host_list else c.deploy_hosts
+    if hosts:
+        _rollout(c, hosts, code, config, check_hotfixes, backup,
+                 int(batch_size or c.rollout_batch_size))
+    else:
+        prepared = _prepare_deploy(c, code, config, check_hotfixes)
+        _cutover(c, *prepared, backup=backup)
+ns.add_task(deploy)
+
+
+def _prepare_deploy(c, code, config, check_hotfixes):
+    """
+    Safe to fail part of deploy. Returns DjangoConnection, version running at
+    the beginning, path of the new version and its pending migrations (None
+    if unknown).
     """
     try:
         s = DjangoConnection.get_instance(c.config)
         beginning_version = s.get_current_version()
         if check_hotfixes:
-            check_uncommited(c)
+            s.check_for_uncommited_changes()
 
         new_path = create_version(c, code, config)
+        if c.preflight:
+            s.django_preflight(new_path)
+        if c.import_warmup:
+            s.django_import_warmup(new_path)
+        migration_plan = None
+        if c.migration_plan:
+            migration_plan = s.django_migration_plan(new_path)
     except Exception as e:
         logger.error("Exception caught. Running Django App was not affected or "
                      "\"touched\".")
         raise Fallback(e)
+    return s, beginning_version, new_path, migration_plan
 
-    # END OF SAFE TO FAIL CODE
 
+def _cutover(c, s, beginning_version, new_path, migration_plan, backup):
+    if migration_plan == [] and c.skip_backup_without_migrations:
+        logger.info("No pending migrations, skipping database backup")
+        backup = False
+    # With a catch-up script the full backup is made while the App runs
+    catchup = backup and c.backup_catchup_script is not None
+    if catchup:
+        try:
+            s.backup_database()
+        except Exception as e:
+            logger.error("Backup failed. Running Django App was not affected "
+                         "or \"touched\".")
+            raise Fallback(e)
     try:
         s.stop_django()
         s.change_codebase(new_path)
 
-        s.django_check_manage()
-        if backup:
+        # With preflight manage.py was checked before stopping the App
+        if not c.preflight:
+            s.django_check_manage()
+        if catchup:
+            s.backup_catchup()
+        elif backup:
             s.backup_database()
         s.django_perform_install()
 
@@ -186,18 +377,116 @@ def deploy(c, code, config, check_hotfixes=True, backup=True):
 
         s.start_django()
         s.check_app_works()
+        try:
+            s.update_manifest(os.path.basename(new_path), status="failed")
+        except Exception as manifest_error:
+            logger.warning("Failed to mark {} as failed in the manifest: {}"
+                           .format(new_path, manifest_error))
         raise Fallback(e)
 
     # END OF CODE WITH FALLBACK
 
     # run manage.py migrate
     # after this, we cannot automatically restore the Django App
-    s.django_migrations()
+    if migration_plan == []:
+        logger.info("No pending migrations, skipping migrate")
+    else:
+        s.django_migrations()
 
     s.start_django()
     s.check_app_works()
-    s.mark_working(new_path)
-ns.add_task(deploy)
+    _check_latency_and_mark_working(c, s, new_path)
+
+    if c.gc_after_deploy:
+        try:
+            s.collect_garbage()
+        except Exception as e:
+            logger.warning("Deleting old versions failed: {}".format(e))
+
+
+def _host_context(c, host):
+    config = c.config.clone()
+    config.host = host
+    return Context(config=config)
+
+
+def _rollout(c, hosts, code, config, check_hotfixes, backup, batch_size):
+    """
+    Creates versions on all hosts in parallel, then cuts over the first
+    rollout_canary hosts one by one and the rest in batches of batch_size
+    hosts.
+
+    The first failure halts the rollout. Fallback is raised only if no host
+    was cut over yet.
+
+    The database is backed up only on the first host, which is therefore
+    always cut over alone before the others.
+    """
+    for name in ("probe_urls", "load_probe_urls"):
+        urls = c.config[name]
+        if name == "probe_urls" and not urls \
+                or any("{host}" not in url for url in urls or []):
+            raise Exception("Deploying to multiple hosts requires {} with "
+                            "{{host}} in every URL, so that each host is "
+                            "probed directly".format(name))
+    contexts = {host: _host_context(c, host) for host in hosts}
+    status = {host: "not started" for host in hosts}
+    timings = {host: {} for host in hosts}
+    prepared = {}
+
+    def prepare(host):
+        start = time.monotonic()
+        prepared[host] = _prepare_deploy(contexts[host], code, config,
+                                         check_hotfixes)
+        timings[host]['prepare'] = time.monotonic() - start
+
+    def cutover(host):
+        start = time.monotonic()
+        _cutover(contexts[host], *prepared[host],
+                 backup=backup and host == hosts[0])
+        timings[host]['cutover'] = time.monotonic() - start
+
+    def run_step(func, step_hosts, done):
+        """
+        Runs func for step_hosts concurrently, returns the first exception
+        """
+        logger.info("Running {} on {}".format(func.__name__,
+                                              ", ".join(step_hosts)))
+        with ThreadPoolExecutor(max_workers=len(step_hosts)) as executor:
+            futures = {host: executor.submit(func, host)
+                       for host in step_hosts}
+        error = None
+        for host, future in futures.items():
+            try:
+                future.result()
+                status[host] = done
+            except Exception as e:
+                status[host] = "{} failed".format(func.__name__)
+                error = error or e
+        return error
+
+    canary = max(c.rollout_canary, 1) if backup else c.rollout_canary
+    batches = [[host] for host in hosts[:canary]] \
+        + [hosts[i:i + batch_size]
+           for i in range(canary, len(hosts), batch_size)]
+    try:
+        error = run_step(prepare, hosts, "prepared")
+        for batch in batches:
+            if error is not None:
+                break
+            error = run_step(cutover, batch, "deployed")
+        if error is not None:
+            logger.error("Rollout halted")
+            if isinstance(error, Fallback) \
+                    and "deployed" in status.values():
+                raise error.original_exception
+            raise error
+    finally:
+        print("Rollout summary:")
+        for host in hosts:
+            print("  {:<30}{:<20}{}".format(host, status[host], " ".join(
+                "{} {:.1f}s".format(name, duration)
+                for name, duration in timings[host].items())))
 
 @task
 @handle_exceptions
@@ -206,16 +495,19 @@ def list_versions(c):
     List available versions
     """
     s = DjangoConnection.get_instance(c.config)
-    interestring_versions = [
-        (s.get_current_version(), 'current'),
-        (s.get_previous_version(), 'previous'),
-        (s.get_working_version(), 'working'),
-        (s.get_previous_working_version(), 'working-old'),
-    ]
-    print("Existing versions: (date-time-code-config)")
-    for version in s.list_versions():
+    versions, tagged, manifest = s.get_versions_state()
+    print("Existing versions: (date-time-code-config, size, build time, "
+          "status)")
+    for version in versions:
+        entry = manifest['versions'].get(version, {})
         print(version, end=" ")
-        for (name, tag) in interestring_versions:
+        if 'size' in entry:
+            print("{:.1f}MB".format(entry['size'] / 10**6), end=" ")
+        if 'build_duration' in entry:
+            print("{:.0f}s".format(entry['build_duration']), end=" ")
+        if 'status' in entry:
+            print(entry['status'], end=" ")
+        for (tag, name) in tagged.items():
             if name == version:
                 print(tag, end=" ")
         print()
@@ -248,3 +540,14 @@ def delete_old_versions(c, to_keep=10):
     else:
         s.delete_versions(sorted(versions)[:-to_keep])
 ns.add_task(delete_old_versions)
+
+
+@task
+@handle_exceptions
+def collect_garbage(c):
+    """
+    Delete old versions according to the gc_* retention options
+    """
+    s = DjangoConnection.get_instance(c.config)
+    s.collect_garbage()
+ns.add_task(collect_garbage)
@@ -0,0 +1,117 @@
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logger import logger
+
+
+class ReadinessProber:
+    """
+    Polls URLs until all of them respond successfully.
+
+    Polling starts fast and backs off up to max_interval. Connections are
+    pooled in a requests.Session and the URLs are probed concurrently.
+    """
+
+    def __init__(self, urls, timeout=5, deadline=60, interval=0.05,
+                 max_interval=1):
+        self.urls = urls
+        self.timeout = timeout
+        self.deadline = deadline
+        self.interval = interval
+        self.max_interval = max_interval
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=len(urls))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _probe(self, url):
+        """
+        Returns whether url responded successfully and time.monotonic() of
+        the response
+        """
+        try:
+            ok = self.session.get(url, timeout=self.timeout).ok
+        except requests.RequestException as e:
+            logger.debug("Probe of {} failed: {}".format(url, e))
+            ok = False
+        return ok, time.monotonic()
+
+    def wait(self):
+        """
+        Returns time.monotonic() of the moment all URLs responded
+        successfully or None when deadline (in seconds) passed
+        """
+        start = time.monotonic()
+        interval = self.interval
+        pending = list(self.urls)
+        ok_at = start
+        with ThreadPoolExecutor(max_workers=len(self.urls)) as executor:
+            while True:
+                results = list(executor.map(self._probe, pending))
+                still_pending = []
+                for url, (ok, at) in zip(pending, results):
+                    if ok:
+                        ok_at = max(ok_at, at)
+                    else:
+                        still_pending.append(url)
+                pending = still_pending
+                if not pending:
+                    return ok_at
+                if time.monotonic() - start > self.deadline:
+                    return None
+                logger.debug("Waiting for the App start...")
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_interval)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1,
+                      max(0, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+def measure_latency(urls, count, concurrency, warmup=0, timeout=5):
+    """
+    Fires count requests spread over urls with given concurrency, after
+    warmup requests which are not measured.
+
+    Returns error rate and p50/p95/p99 latency (in seconds) of successful
+    requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def request(url):
+        start = time.monotonic()
+        try:
+            ok = session.get(url, timeout=timeout).ok
+        except requests.RequestException:
+            ok = False
+        return ok, time.monotonic() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(request,
+                              [urls[i % len(urls)] for i in range(warmup)]))
+            results = list(executor.map(
+                request, [urls[i % len(urls)] for i in range(count)]))
+    finally:
+        session.close()
+    latencies = sorted(elapsed for ok, elapsed in results if ok)
+    return {
+        'requests': count,
+        'error_rate': (count - len(latencies)) / count,
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99),
+    }
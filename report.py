@@ -0,0 +1,178 @@
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from decorator import decorator
+
+from logger import logger
+
+
+class DeployReport:
+    """
+    Durations and remote command counts of named deployment phases and the
+    downtime window of a single host
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = datetime.datetime.now()
+        self._start = time.monotonic()
+        self.phases = []
+        self.commands = 0
+        self.bytes = 0
+        self.values = {}
+        self._running = []
+        self._down_at = None
+        self.downtime = None
+
+    @contextmanager
+    def phase(self, name):
+        entry = {'name': name, 'commands': 0}
+        start = time.monotonic()
+        with self._lock:
+            self._running.append(entry)
+        try:
+            yield entry
+        finally:
+            entry['duration'] = time.monotonic() - start
+            with self._lock:
+                self._running.remove(entry)
+                self.phases.append(entry)
+
+    def count_command(self):
+        with self._lock:
+            self.commands += 1
+            if self._running:
+                self._running[-1]['commands'] += 1
+
+    def count_bytes(self, count):
+        with self._lock:
+            self.bytes += count
+
+    def mark_down(self):
+        """
+        Marks the App was stopped, only the first stop is recorded
+        """
+        if self._down_at is None:
+            self._down_at = time.monotonic()
+
+    def mark_up(self, at=None):
+        """
+        Marks the App responds again (at given time.monotonic() value) and
+        closes the downtime window
+        """
+        if self._down_at is not None and self.downtime is None:
+            if at is None:
+                at = time.monotonic()
+            self.downtime = at - self._down_at
+
+    def record(self, key, value):
+        self.values[key] = value
+
+    def as_dict(self):
+        return {
+            'host': self.host,
+            'started': self.started.isoformat(),
+            'duration': time.monotonic() - self._start,
+            'commands': self.commands,
+            'bytes': self.bytes,
+            'downtime': self.downtime,
+            'phases': self.phases,
+            'values': self.values,
+        }
+
+    def summary(self):
+        totals = {}
+        for entry in self.phases:
+            duration, commands = totals.get(entry['name'], (0, 0))
+            totals[entry['name']] = (duration + entry['duration'],
+                                     commands + entry['commands'])
+        lines = ["{}: {:.2f}s, {} remote commands, {} bytes, downtime {}"
+                 .format(self.host, time.monotonic() - self._start,
+                         self.commands, self.bytes,
+                         "-" if self.downtime is None
+                         else "{:.2f}s".format(self.downtime))]
+        lines.append("  {:<16}{:>10}{:>10}".format("phase", "time", "commands"))
+        for name, (duration, commands) in totals.items():
+            lines.append("  {:<16}{:>9.2f}s{:>10}".format(name, duration,
+                                                         commands))
+        return "\n".join(lines)
+
+
+# Reports by host
+reports = {}
+_reported_depth = 0
+_depth_lock = threading.Lock()
+
+
+def get_report(host):
+    if host not in reports:
+        reports[host] = DeployReport(host)
+    return reports[host]
+
+
+def phase(name):
+    """
+    Decorator recording a DjangoConnection method as a phase of its report
+    """
+    @decorator
+    def wrapper(func, self, *args, **kwargs):
+        with self.report.phase(name):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+@decorator
+def reported(func, c, *args, **kwargs):
+    """
+    Resets reports at the start of the outermost reported task. At its end
+    prints a summary and saves reports of all hosts to report_file and
+    appends them to report_history_file.
+    """
+    global _reported_depth
+    with _depth_lock:
+        _reported_depth += 1
+        outermost = _reported_depth == 1
+    if outermost:
+        for report in reports.values():
+            report.reset()
+    success = False
+    try:
+        result = func(c, *args, **kwargs)
+        success = True
+        return result
+    finally:
+        with _depth_lock:
+            _reported_depth -= 1
+        if outermost:
+            save_reports(c.config, func.__name__, success)
+
+
+def save_reports(config, task, success):
+    used = [report for report in reports.values() if report.commands]
+    if not used:
+        return
+    data = {
+        'task': task,
+        'success': success,
+        'finished': datetime.datetime.now().isoformat(),
+        'hosts': [report.as_dict() for report in used],
+    }
+    print("Report of {} ({}):".format(task, "success" if success else "failed"))
+    for report in used:
+        print(report.summary())
+    try:
+        if config.report_file is not None:
+            with open(config.report_file, "w") as f:
+                json.dump(data, f, indent=2)
+        if config.report_history_file is not None:
+            with open(config.report_history_file, "a") as f:
+                f.write(json.dumps(data) + "\n")
+    except OSError as e:
+        logger.warning("Failed to save deploy report: {}".format(e))
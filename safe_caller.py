@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 import sys
 import caller_config
+import json
+import shlex
 import subprocess
+import socket
 import os
+import re
+import time
+import shutil
+import tempfile
 from filelock import FileLock
 
 
+# Names of deploy requests in deploy_queue_dir: request time and caller pid
+REQUEST_NAME = re.compile(r"\d{20}-\d+")
+
+
 class InvalidCommit(Exception):
     pass
 
@@ -17,12 +28,187 @@ def sanitize_commit_info(commit: str) -> str:
     return commit
 
 
-def get_master_hash_of_repo(url: str):
+def get_branch_hash_of_repo(url: str, branch: str):
     return subprocess.check_output(
-            ["git", "ls-remote", url, "refs/heads/master"]
+            ["git", "ls-remote", url, "refs/heads/" + branch]
         ).decode('ascii').split("\t")[0]
 
 
+def get_config_branch() -> str:
+    """
+    config_branch from caller_config or from fabric.yml of the deployment
+    script
+    """
+    branch = getattr(caller_config, "config_branch", None)
+    if branch is None:
+        # PyYAML is needed only when config_branch is not in caller_config
+        import yaml
+        with open(os.path.join(caller_config.deployment_script_root,
+                               "fabric.yml")) as f:
+            branch = (yaml.safe_load(f) or {}).get("config_branch", "master")
+    return branch
+
+
+def get_cached_branch_hash(mirror: str, url: str, branch: str) -> str:
+    """
+    Resolves branch in a local mirror of the repository.
+
+    The mirror is used as is if fetched less than config_ref_ttl seconds ago
+    (and is refreshed in the background once half of that passed). Otherwise
+    it is fetched first; if that fails, a mirror fetched less than
+    config_ref_max_stale seconds ago is still used.
+    """
+    ttl = getattr(caller_config, "config_ref_ttl", 30)
+    max_stale = getattr(caller_config, "config_ref_max_stale", 600)
+    stamp = os.path.join(mirror, "fetched")
+    fetch = "git --git-dir={0} fetch --quiet origin && touch {0}/fetched" \
+        .format(shlex.quote(mirror))
+    if not os.path.isdir(mirror):
+        # Cloned next to the mirror and renamed, so concurrent callers never
+        # see a partial clone; the loser of a race uses the winner's mirror
+        tmp = tempfile.mkdtemp(prefix=os.path.basename(mirror) + ".",
+                               dir=os.path.dirname(os.path.abspath(mirror)))
+        try:
+            subprocess.check_call(["git", "clone", "--quiet", "--mirror",
+                                   url, tmp])
+            open(os.path.join(tmp, "fetched"), "w").close()
+            os.rename(tmp, mirror)
+        except (subprocess.CalledProcessError, OSError):
+            if not os.path.isdir(mirror):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    # A mirror without the stamp (e.g. from an older version) is stale
+    age = (time.time() - os.path.getmtime(stamp)
+           if os.path.exists(stamp) else float("inf"))
+    if age >= ttl:
+        try:
+            subprocess.run(fetch, shell=True, check=True, timeout=ttl)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as e:
+            if age >= max_stale:
+                raise
+            print("Fetching {} failed ({}), using {:.0f}s old mirror"
+                  .format(url, e, age), flush=True)
+    elif age >= ttl / 2:
+        subprocess.Popen(fetch, shell=True, start_new_session=True,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    return subprocess.check_output(
+            ["git", "--git-dir", mirror, "rev-parse", "refs/heads/" + branch]
+        ).decode('ascii').strip()
+
+
+def get_config_hash() -> str:
+    branch = get_config_branch()
+    mirror = getattr(caller_config, "config_mirror_dir", None)
+    if mirror is None:
+        return get_branch_hash_of_repo(caller_config.config_repo, branch)
+    return get_cached_branch_hash(mirror, caller_config.config_repo, branch)
+
+
+def run_deploy(code_commit: str, config_commit: str) -> int:
+    socket_path = getattr(caller_config, "daemon_socket", None)
+    if socket_path is not None:
+        try:
+            return run_daemon_deploy(socket_path, code_commit, config_commit)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("Deploy daemon not running, falling back to fab", flush=True)
+    return subprocess.call(
+        [caller_config.fab_path, "deploy", code_commit, config_commit],
+        cwd=caller_config.deployment_script_root,
+    )
+
+
+def run_daemon_deploy(socket_path: str, code_commit: str,
+                      config_commit: str) -> int:
+    """
+    Runs deploy in deploy_daemon, printing its output as it arrives
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps({'code': code_commit,
+                                  'config': config_commit}) + "\n").encode())
+        for line in sock.makefile(encoding="utf-8"):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            print(message['output'], end="", flush=True)
+    print("Deploy daemon disconnected")
+    return 1
+
+
+def enqueue(queue_dir: str, code_commit: str, config_commit: str) -> str:
+    """
+    Records a deploy request in queue_dir. Returns its name, names sort by
+    request time.
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    name = "{:020d}-{}".format(time.time_ns(), os.getpid())
+    with open(os.path.join(queue_dir, name), "w") as f:
+        f.write("{} {}".format(code_commit, config_commit))
+    return name
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_superseding(queue_dir: str, name: str):
+    """
+    Returns (code, config) of the newest request newer than request name -
+    either waiting or already deployed - or None if there is no such request
+    """
+    newest = None
+    for entry in sorted(os.listdir(queue_dir)):
+        # Skips "deployed", its temporary file and anything unknown
+        if not REQUEST_NAME.fullmatch(entry) or entry <= name:
+            continue
+        if not is_alive(int(entry.split("-")[1])):
+            # Left by a killed caller
+            os.remove(os.path.join(queue_dir, entry))
+            continue
+        newest = entry
+    if newest is not None:
+        with open(os.path.join(queue_dir, newest)) as f:
+            return tuple(f.read().split())
+    deployed = os.path.join(queue_dir, "deployed")
+    if os.path.exists(deployed):
+        with open(deployed) as f:
+            deployed_name, code_commit, config_commit = f.read().split()
+        if deployed_name > name:
+            return code_commit, config_commit
+    return None
+
+
+def coalesced_deploy(queue_dir: str, lock: FileLock,
+                     code_commit: str, config_commit: str):
+    """
+    Deploys given commits unless a newer request arrives while waiting for
+    the lock. Returns (deploy return code, None) or (None, superseding
+    (code, config)).
+    """
+    name = enqueue(queue_dir, code_commit, config_commit)
+    try:
+        with lock:
+            superseding = get_superseding(queue_dir, name)
+            if superseding is not None:
+                return None, superseding
+            with open(os.path.join(queue_dir, "deployed.tmp"), "w") as f:
+                f.write("{} {} {}".format(name, code_commit, config_commit))
+            os.replace(os.path.join(queue_dir, "deployed.tmp"),
+                       os.path.join(queue_dir, "deployed"))
+            return run_deploy(code_commit, config_commit), None
+    finally:
+        os.remove(os.path.join(queue_dir, name))
+
+
 def main():
     args = sys.argv[1:]
     if 'SSH_ORIGINAL_COMMAND' in os.environ:
@@ -31,9 +217,7 @@ def main():
     try:
         if len(args) == 1:
             code_commit = sanitize_commit_info(args[0])
-            config_commit = sanitize_commit_info(
-                get_master_hash_of_repo(caller_config.config_repo)
-            )
+            config_commit = sanitize_commit_info(get_config_hash())
         elif len(args) == 2:
             code_commit = sanitize_commit_info(args[0])
             config_commit = sanitize_commit_info(args[1])
@@ -41,11 +225,16 @@ def main():
             print("Wrong number of arguments - " + str(len(args)))
             sys.exit(1)
         lock = FileLock("deploy.lock")
-        with lock:
-            ret = subprocess.call(
-                [caller_config.fab_path, "deploy", code_commit, config_commit],
-                cwd=caller_config.deployment_script_root,
-            )
+        queue_dir = getattr(caller_config, "deploy_queue_dir", None)
+        if queue_dir is None:
+            with lock:
+                ret = run_deploy(code_commit, config_commit)
+        else:
+            ret, superseding = coalesced_deploy(queue_dir, lock, code_commit,
+                                                config_commit)
+            if superseding is not None:
+                print("Superseded by {} {}".format(*superseding))
+                sys.exit(0)
         if ret != 0:
             if ret < 0:
                 print("Killed by signal", -ret)
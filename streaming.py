@@ -0,0 +1,55 @@
+import datetime
+
+from fabric.runners import Remote
+from invoke.runners import Local
+
+from logger import logger
+
+# Longer output without a newline (e.g. progress bars) is logged in parts
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class StreamingOutputMixin:
+    """
+    Logs output lines of the command with timestamps as they arrive instead
+    of echoing it. Only the last stream_tail_lines lines of stdout and stderr
+    are kept for the Result, so memory stays bounded on huge outputs. The
+    whole output is counted in the report of the context, if it has one.
+
+    Watchers (autoresponders) are not supported.
+    """
+
+    def _handle_output(self, buffer_, hide, output, reader):
+        # del buffer_[:-0] would delete nothing, so at least a line is kept
+        tail_lines = max(1, self.context.config.stream_tail_lines)
+        report = getattr(self.context, "report", None)
+        partial = ""
+        for data in self.read_proc_output(reader):
+            if report is not None:
+                report.count_bytes(len(data))
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            if len(partial) > MAX_LINE_LENGTH:
+                lines.append(partial)
+                partial = ""
+            for line in lines:
+                self._log_line(line)
+                buffer_.append(line + "\n")
+            del buffer_[:-tail_lines]
+        if partial:
+            self._log_line(partial)
+            buffer_.append(partial)
+            del buffer_[:-tail_lines]
+
+    def _log_line(self, line):
+        logger.info("{:%H:%M:%S} {}| {}".format(
+            datetime.datetime.now(), getattr(self.context, "host", ""),
+            line.rstrip("\r")))
+
+
+class StreamingRemote(StreamingOutputMixin, Remote):
+    pass
+
+
+class StreamingLocal(StreamingOutputMixin, Local):
+    pass
@@ -5,7 +5,16 @@ import invoke.exceptions
 from logger import logger
 
 
-EXTERNAL_EXCEPTIONS = (invoke.exceptions.UnexpectedExit, AssertionError)
+class LatencyRegression(Exception):
+    """
+    The App responds too slowly or with too many errors compared to the
+    working version
+    """
+    pass
+
+
+EXTERNAL_EXCEPTIONS = (invoke.exceptions.UnexpectedExit, AssertionError,
+                       LatencyRegression)
 
 
 class Fallback(Exception):